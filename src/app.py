@@ -1,8 +1,15 @@
 import streamlit as st
 import pandas as pd
 import boto3
+import hashlib
+import io
 import json
-import time
+import orjson
+import re
+import textwrap
+from botocore.config import Config
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 
 # --- Page Config (Branding) ---
 st.set_page_config(
@@ -60,16 +67,26 @@ region = st.sidebar.text_input(
     help="AWS region where Bedrock is available (e.g., us-east-1, us-west-2)"
 )
 
+SONNET_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+HAIKU_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
 model_id = st.sidebar.selectbox(
     "Select Foundation Model",
     [
-        "anthropic.claude-3-sonnet-20240229-v1:0",
-        "anthropic.claude-3-haiku-20240307-v1:0"
+        SONNET_MODEL_ID,
+        HAIKU_MODEL_ID
     ],
-    index=0,
+    index=1,
     help="Choose the Claude model to use for test case generation"
 )
 
+escalate_low_confidence = st.sidebar.checkbox(
+    "Escalate low-confidence stories to Sonnet",
+    value=True,
+    disabled=model_id == SONNET_MODEL_ID,
+    help="Re-generate stories whose test cases score below 0.8 confidence with Claude 3 Sonnet"
+)
+
 temperature = st.sidebar.slider(
     "Temperature",
     min_value=0.0,
@@ -99,7 +116,11 @@ st.sidebar.info(
 )
 
 # --- Token and Cost Calculation ---
-def calculate_bedrock_cost(model_id, input_tokens, output_tokens):
+# Prompt cache reads are billed at 10% of the base input price, writes at 125%
+CACHE_READ_PRICE_FACTOR = 0.1
+CACHE_WRITE_PRICE_FACTOR = 1.25
+
+def calculate_bedrock_cost(model_id, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0):
     """Calculate approximate cost for Claude models on Bedrock (per 1M tokens)"""
     # Claude 3 Sonnet pricing (as of 2024)
     sonnet_input = 0.003      # $3 per 1M input tokens
@@ -110,87 +131,535 @@ def calculate_bedrock_cost(model_id, input_tokens, output_tokens):
     haiku_output = 0.00125    # $1.25 per 1M output tokens
     
     if "sonnet" in model_id.lower():
-        input_cost = (input_tokens / 1000000) * sonnet_input
-        output_cost = (output_tokens / 1000000) * sonnet_output
+        input_price, output_price = sonnet_input, sonnet_output
     else:  # Haiku
-        input_cost = (input_tokens / 1000000) * haiku_input
-        output_cost = (output_tokens / 1000000) * haiku_output
+        input_price, output_price = haiku_input, haiku_output
+    
+    # Cached prompt tokens are reported separately from the uncached input tokens
+    billed_input_tokens = (
+        input_tokens
+        + cache_read_tokens * CACHE_READ_PRICE_FACTOR
+        + cache_write_tokens * CACHE_WRITE_PRICE_FACTOR
+    )
+    input_cost = (billed_input_tokens / 1000000) * input_price
+    output_cost = (output_tokens / 1000000) * output_price
     
     total_cost = input_cost + output_cost
     return total_cost, input_tokens, output_tokens
 
 # --- Bedrock Integration Function ---
-def generate_tests_with_bedrock(row, model_arn, credentials, region, temp, max_tok):
-    """Calls AWS Bedrock to generate test cases for a single story."""
+# Upper bound on concurrent Bedrock requests per generation run
+MAX_PARALLEL_REQUESTS = 10
+
+# Size the HTTP connection pool to the thread pool so workers never wait on a socket
+BEDROCK_CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_PARALLEL_REQUESTS,
+    retries={"mode": "adaptive", "max_attempts": 3}
+)
+
+# Prompt building blocks shared by the single-story and batch system prompts
+QA_ROLE = "You are a Senior QA Automation Engineer for a major Insurance Provider."
+
+TEST_CASE_EXAMPLE = """{
+    "TestID": "TC-<Story ID>-01",
+    "Type": "Positive/Negative/Edge",
+    "Summary": "Short summary...",
+    "Steps": "1. Step one... 2. Step two...",
+    "Expected_Result": "...",
+    "Confidence": 0.95
+}"""
+
+CONFIDENCE_INSTRUCTION = (
+    "Also include a 'Confidence' field (0.0-1.0) on each test case indicating "
+    "how confident you are in its quality."
+)
+
+def build_preamble(task, output_requirement, output_format):
+    """Assembles a system prompt from the shared role, output format and confidence blocks."""
+    return f"""{QA_ROLE}
+
+{task}
+
+OUTPUT REQUIREMENTS:
+{output_requirement}
+Format:
+{output_format}
+
+{CONFIDENCE_INSTRUCTION}
+"""
+
+# Static instructions shared by every story, sent as the system prompt. Note that Bedrock
+# only caches prefixes of at least 1,024 tokens (2,048 on Haiku) on the models listed in
+# PROMPT_CACHING_MODELS; this preamble is ~120 tokens and neither selectable model is
+# listed, so prompt caching is currently inactive and CachedInputTokens stays 0.
+STATIC_PREAMBLE = build_preamble(
+    "You will be given a single User Story. Analyze it and design test cases for it.",
+    "Generate 2-3 specific Test Cases. Return ONLY valid JSON.",
+    "[\n" + textwrap.indent(TEST_CASE_EXAMPLE, " " * 4) + "\n]"
+)
+
+# Batch variant of the preamble: one request covers several stories
+BATCH_PREAMBLE = build_preamble(
+    "You will be given several User Stories. Analyze each one and design test cases for it.",
+    "Generate 2-3 specific Test Cases per story. Return ONLY valid JSON: one entry per story, keyed by its ID.",
+    "[\n"
+    "    {\n"
+    '        "FormattedID": "<Story ID>",\n'
+    '        "TestCases": [\n'
+    + textwrap.indent(TEST_CASE_EXAMPLE, " " * 12) + "\n"
+    "        ]\n"
+    "    }\n"
+    "]"
+)
+
+# Stories are grouped into batch requests sized so the combined reply fits in max_tokens
+MAX_BATCH_SIZE = 5
+ESTIMATED_OUTPUT_TOKENS_PER_STORY = 600
+
+# CSV columns sent to the model for each story
+STORY_FIELDS = ['FormattedID', 'Name', 'Description', 'AcceptanceCriteria']
+
+# Per-story user message, filled from the story's CSV columns
+USER_PROMPT_TEMPLATE = """Analyze this User Story:
+ID: {FormattedID}
+Title: {Name}
+Description: {Description}
+Acceptance Criteria: {AcceptanceCriteria}
+"""
+
+# Bedrock only accepts cache_control for models with prompt caching support.
+# None of the models offered in the sidebar are listed here yet.
+PROMPT_CACHING_MODELS = (
+    "claude-3-5-haiku",
+    "claude-3-7-sonnet",
+    "claude-sonnet-4",
+    "claude-opus-4",
+)
+
+def supports_prompt_caching(model_id):
+    """Returns True if the Bedrock model accepts cache_control blocks."""
+    # Substring match so cross-region inference profiles (e.g. "us.anthropic...") are covered
+    return any(model in model_id for model in PROMPT_CACHING_MODELS)
+
+def get_bedrock_client(credentials, region):
+    """Returns a Bedrock runtime client, reusing the one cached in session state when possible."""
+    # Hash the credentials so the raw secret is not duplicated into the cache key
+    secret_material = f"{credentials.get('access_key')}:{credentials.get('secret_key')}"
+    cache_key = (region, hashlib.sha256(secret_material.encode("utf-8")).hexdigest())
     
-    try:
-        # Initialize Bedrock client with provided credentials
-        bedrock = boto3.client(
+    if st.session_state.get("bedrock_client_key") != cache_key:
+        st.session_state.bedrock_client = boto3.client(
             service_name="bedrock-runtime",
             region_name=region,
             aws_access_key_id=credentials.get("access_key"),
-            aws_secret_access_key=credentials.get("secret_key")
+            aws_secret_access_key=credentials.get("secret_key"),
+            config=BEDROCK_CLIENT_CONFIG
         )
+        st.session_state.bedrock_client_key = cache_key
+    
+    return st.session_state.bedrock_client
+
+# Only reuse responses when sampling is close to deterministic
+CACHEABLE_MAX_TEMPERATURE = 0.2
+
+def invoke_bedrock_streaming(bedrock_client, model_arn, body, on_text=None):
+    """Invokes Bedrock with response streaming and reassembles the non-streaming response shape.
+
+    on_text, if given, is called with each text delta as it arrives so callers can
+    report progress before the full reply is in.
+    """
+    response = bedrock_client.invoke_model_with_response_stream(modelId=model_arn, body=body)
+    text_parts = []
+    usage = {}
+    
+    for event in response.get("body"):
+        chunk = event.get("chunk")
+        if chunk is None:
+            continue
+        payload = orjson.loads(chunk["bytes"])
+        event_type = payload.get("type")
         
-        prompt = f"""
-    You are a Senior QA Automation Engineer for a major Insurance Provider.
+        if event_type == "message_start":
+            # Input and prompt cache token counts arrive up front
+            usage.update(payload["message"].get("usage", {}))
+        elif event_type == "content_block_delta" and payload["delta"].get("type") == "text_delta":
+            text_parts.append(payload["delta"]["text"])
+            if on_text is not None:
+                on_text(payload["delta"]["text"])
+        elif event_type == "message_delta":
+            # Final output token count
+            usage.update(payload.get("usage", {}))
+        elif event_type == "message_stop":
+            break
     
-    Analyze this User Story:
-    ID: {row['FormattedID']}
-    Title: {row['Name']}
-    Description: {row['Description']}
-    Acceptance Criteria: {row['AcceptanceCriteria']}
+    return {"content": [{"type": "text", "text": "".join(text_parts)}], "usage": usage}
+
+# Outermost JSON array in the model's reply (greedy, spans newlines)
+JSON_ARRAY_PATTERN = re.compile(r"\[.*\]", re.S)
+
+def parse_json(raw):
+    """Parses JSON with orjson, falling back to the stdlib for input orjson rejects (e.g. NaN)."""
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+def extract_test_cases(result_text):
+    """Extracts the JSON array of test cases from the model's chat text."""
+    match = JSON_ARRAY_PATTERN.search(result_text)
+    if match is None:
+        raise ValueError("No JSON array found in model response")
+    return parse_json(match.group(0))
+
+class UnparsableReplyError(ValueError):
+    """Raised when a reply that was paid for holds no valid JSON array; carries its usage."""
+
+    def __init__(self, message, usage):
+        super().__init__(message)
+        self.usage = usage
+
+def request_json_array(bedrock_client, model_arn, body, on_text=None):
+    """Invokes Bedrock and parses the JSON array out of the reply.
+
+    Returns the parsed array and the response usage. Raises UnparsableReplyError,
+    carrying the response usage, when the reply holds no valid array (e.g. it was
+    cut off at max_tokens).
+    """
+    response_body = invoke_bedrock_streaming(bedrock_client, model_arn, body, on_text)
+    result_text = response_body['content'][0]['text']
+    usage = dict(response_body.get('usage', {}))
+    usage.setdefault('output_tokens', len(result_text.split()))
+    try:
+        return extract_test_cases(result_text), usage
+    except ValueError as e:
+        raise UnparsableReplyError(str(e), usage) from e
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def request_json_array_cached(_bedrock_client, cache_scope, model_arn, body, _on_text=None, _misses=None):
+    """Cached request_json_array, keyed on the account, model and request body.
+
+    st.cache_data is shared by every session on the server, so cache_scope (the
+    region and credential hash from get_bedrock_client) is part of the key: a
+    session only reuses replies its own credentials paid for. The client and
+    callbacks are excluded from the key (leading underscore); the body bytes
+    already carry the temperature and the full story content.
+    st.cache_data does not store exceptions, so only replies that parsed are cached
+    and a malformed one is retried on the next run. The body is appended to _misses
+    only when Bedrock is actually called, which lets the caller recognise cache hits.
+    """
+    if _misses is not None:
+        _misses.append(body)
+    return request_json_array(_bedrock_client, model_arn, body, _on_text)
+
+def invoke_claude(bedrock_client, model_arn, system_prompt, user_prompt, temp, max_tok, on_text=None, cache_scope=None):
+    """Sends one system + user prompt to Claude on Bedrock.
+
+    Returns the JSON array parsed from the reply and a usage dict with token counts
+    and estimated cost. Replies served from the response cache cost nothing, so
+    their usage is reported as zero and flagged with FromResponseCache.
+    on_text is called with each streamed text delta (not called on cache hits).
+    The response cache is only used when cache_scope identifies the account.
+    An UnparsableReplyError is re-raised with its usage in the same format.
+    """
+    system_block = {"type": "text", "text": system_prompt}
+    if supports_prompt_caching(model_arn):
+        # Let Bedrock reuse the preamble prefill across every request in the run
+        system_block["cache_control"] = {"type": "ephemeral"}
+
+    # orjson emits UTF-8 bytes directly, which boto3 sends without re-encoding
+    body = orjson.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tok,
+        "temperature": temp,
+        "system": [system_block],
+        "messages": [{"role": "user", "content": [{"type": "text", "text": user_prompt}]}]
+    })
+
+    try:
+        if cache_scope is not None and temp <= CACHEABLE_MAX_TEMPERATURE:
+            misses = []
+            parsed, usage = request_json_array_cached(bedrock_client, cache_scope, model_arn, body, on_text, misses)
+            from_response_cache = not misses
+        else:
+            parsed, usage = request_json_array(bedrock_client, model_arn, body, on_text)
+            from_response_cache = False
+    except UnparsableReplyError as e:
+        # The malformed reply was still billed; let the caller count it
+        raise UnparsableReplyError(str(e), summarize_usage(model_arn, e.usage, system_prompt, user_prompt)) from e
     
-    OUTPUT REQUIREMENTS:
-    Generate 2-3 specific Test Cases. Return ONLY valid JSON.
-    Format:
-    [
-        {{
-            "TestID": "TC-{row['FormattedID']}-01",
-            "Type": "Positive/Negative/Edge",
-            "Summary": "Short summary...",
-            "Steps": "1. Step one... 2. Step two...",
-            "Expected_Result": "...",
-            "Confidence": 0.95
-        }}
-    ]
+    if from_response_cache:
+        return parsed, {
+            'InputTokens': 0,
+            'CachedInputTokens': 0,
+            'OutputTokens': 0,
+            'EstimatedCost': 0.0,
+            'FromResponseCache': True
+        }
+    
+    return parsed, summarize_usage(model_arn, usage, system_prompt, user_prompt)
+
+def summarize_usage(model_arn, usage, system_prompt, user_prompt):
+    """Converts Bedrock response usage into token counts and estimated cost."""
+    # Extract token usage from response metadata
+    uncached_input_tokens = usage.get('input_tokens', len(system_prompt.split()) + len(user_prompt.split()))
+    cache_read_tokens = usage.get('cache_read_input_tokens', 0)
+    cache_write_tokens = usage.get('cache_creation_input_tokens', 0)
+    output_tokens = usage['output_tokens']
+    cost, _, _ = calculate_bedrock_cost(
+        model_arn, uncached_input_tokens, output_tokens, cache_read_tokens, cache_write_tokens
+    )
     
-    Also include a 'Confidence' field (0.0-1.0) indicating how confident you are in the test case quality.
+    return {
+        'InputTokens': uncached_input_tokens + cache_read_tokens + cache_write_tokens,
+        'CachedInputTokens': cache_read_tokens,
+        'OutputTokens': output_tokens,
+        'EstimatedCost': cost,
+        'FromResponseCache': False
+    }
+
+def usage_columns(usage, share=1.0):
+    """Returns the per-test usage columns for a story's share of one request."""
+    input_tokens = round(usage['InputTokens'] * share)
+    output_tokens = round(usage['OutputTokens'] * share)
+    return {
+        'InputTokens': input_tokens,
+        'CachedInputTokens': round(usage['CachedInputTokens'] * share),
+        'OutputTokens': output_tokens,
+        'TotalTokens': input_tokens + output_tokens,
+        'EstimatedCost': round(usage['EstimatedCost'] * share, 6),
+        'FromResponseCache': usage['FromResponseCache']
+    }
+
+def add_usage_columns(test_cases, usage, share=1.0):
+    """Adds token and cost info to each test case, scaled by this story's share of the request."""
+    columns = usage_columns(usage, share)
+    for test in test_cases:
+        test.update(columns)
+
+def generate_tests_with_bedrock(row, bedrock_client, model_arn, temp, max_tok, on_text=None, cache_scope=None):
+    """Calls AWS Bedrock to generate test cases for a single story.
+
+    Runs on a worker thread, so errors are raised to the caller rather than
+    rendered here; Streamlit elements must be created on the script thread.
     """
+    user_prompt = USER_PROMPT_TEMPLATE.format_map(row)
+    test_cases, usage = invoke_claude(
+        bedrock_client, model_arn, STATIC_PREAMBLE, user_prompt, temp, max_tok, on_text, cache_scope
+    )
+    add_usage_columns(test_cases, usage)
+    
+    return test_cases
 
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": max_tok,
-            "temperature": temp,
-            "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
-        })
+def plan_batches(pending, max_tok):
+    """Groups (position, story) pairs into batches whose replies should fit in max_tok.
 
-        response = bedrock.invoke_model(modelId=model_arn, body=body)
-        response_body = json.loads(response.get("body").read())
-        result_text = response_body['content'][0]['text']
-        
-        # Extract token usage from response metadata
-        input_tokens = response_body.get('usage', {}).get('input_tokens', len(prompt.split()))
-        output_tokens = response_body.get('usage', {}).get('output_tokens', len(result_text.split()))
-        
-        # Extract JSON from potential chat text
-        json_start = result_text.find('[')
-        json_end = result_text.rfind(']') + 1
-        test_cases = json.loads(result_text[json_start:json_end])
-        
-        # Add token and cost info to each test case
-        cost, _, _ = calculate_bedrock_cost(model_arn, input_tokens, output_tokens)
-        for test in test_cases:
-            test['InputTokens'] = input_tokens
-            test['OutputTokens'] = output_tokens
-            test['TotalTokens'] = input_tokens + output_tokens
-            test['EstimatedCost'] = round(cost, 6)
-        
-        return test_cases
-        
-    except Exception as e:
-        st.error(f"Error calling Bedrock: {str(e)}")
+    Batch size is max_tok // ESTIMATED_OUTPUT_TOKENS_PER_STORY, capped at MAX_BATCH_SIZE.
+    Returns an empty list when fewer than two stories fit in one reply; a trailing
+    single story is left out and goes through the per-story path instead.
+    """
+    batch_size = min(MAX_BATCH_SIZE, max_tok // ESTIMATED_OUTPUT_TOKENS_PER_STORY)
+    if batch_size < 2:
         return []
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    return [batch for batch in batches if len(batch) > 1]
+
+def generate_tests_batch(stories, bedrock_client, model_arn, temp, max_tok, on_text=None, cache_scope=None):
+    """Calls AWS Bedrock once to generate test cases for several stories.
+
+    Returns a dict mapping FormattedID to that story's test cases. Stories the
+    model left out of its reply are missing from the dict.
+    """
+    user_prompt = "\n".join(USER_PROMPT_TEMPLATE.format_map(story) for story in stories)
+    story_results, usage = invoke_claude(
+        bedrock_client, model_arn, BATCH_PREAMBLE, user_prompt, temp, max_tok, on_text, cache_scope
+    )
+    
+    requested_ids = {str(story['FormattedID']) for story in stories}
+    tests_by_story = {
+        str(story['FormattedID']): story.get('TestCases', [])
+        for story in story_results
+        if str(story.get('FormattedID')) in requested_ids
+    }
+    
+    # Split the single request's usage evenly across the stories it answered
+    for test_cases in tests_by_story.values():
+        add_usage_columns(test_cases, usage, share=1.0 / max(len(tests_by_story), 1))
+    
+    return tests_by_story
+
+# How often the main thread refreshes streamed-token progress while workers run
+STREAM_PROGRESS_INTERVAL = 0.5
+# Rough characters-per-token ratio for progress display only
+CHARS_PER_TOKEN = 4
+
+def run_streaming_jobs(jobs, on_progress=None):
+    """Runs Bedrock jobs on a thread pool and yields (key, result, error) as each completes.
+
+    jobs maps a key to a callable taking an on_text callback. Bedrock calls are
+    blocking I/O, so they overlap well across threads; error is None on success.
+    on_progress is called on the caller's thread with the approximate number of
+    output tokens streamed so far across all jobs.
+    """
+    # One pre-created slot per job so workers never resize the dict while it is summed
+    streamed_chars = {key: 0 for key in jobs}
+
+    def track_stream(key):
+        def on_text(text):
+            streamed_chars[key] += len(text)
+        return on_text
+
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_REQUESTS, len(jobs))) as executor:
+        futures = {executor.submit(job, track_stream(key)): key for key, job in jobs.items()}
+
+        not_done = set(futures)
+        while not_done:
+            done, not_done = wait(not_done, timeout=STREAM_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            if on_progress is not None:
+                on_progress(sum(streamed_chars.values()) // CHARS_PER_TOKEN)
+
+            for future in done:
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, e
+                yield futures[future], result, error
+
+def generate_tests_in_parallel(pending, bedrock_client, model_arn, temp, max_tok, on_progress=None, cache_scope=None):
+    """Runs generate_tests_with_bedrock for each (position, story) pair on a thread pool.
+
+    Yields (position, story, tests, error) as each request completes.
+    """
+    stories = dict(pending)
+    jobs = {
+        position: partial(
+            generate_tests_with_bedrock, row, bedrock_client, model_arn, temp, max_tok, cache_scope=cache_scope
+        )
+        for position, row in pending
+    }
+    for position, tests, error in run_streaming_jobs(jobs, on_progress):
+        yield position, stories[position], tests or [], error
+
+def generate_batches_in_parallel(batches, bedrock_client, model_arn, temp, max_tok, on_progress=None, cache_scope=None):
+    """Runs generate_tests_batch for each batch of (position, story) pairs on a thread pool.
+
+    Yields (batch, tests_by_story, error) as each request completes.
+    """
+    jobs = {
+        index: partial(
+            generate_tests_batch, [row for _, row in batch], bedrock_client, model_arn, temp, max_tok,
+            cache_scope=cache_scope
+        )
+        for index, batch in enumerate(batches)
+    }
+    for index, tests_by_story, error in run_streaming_jobs(jobs, on_progress):
+        yield batches[index], tests_by_story or {}, error
+
+# Cheap-model-first cascade: stories below this confidence are regenerated on Sonnet
+ESCALATION_MODEL_ID = SONNET_MODEL_ID
+ESCALATION_CONFIDENCE_THRESHOLD = 0.8
+
+# Per-test usage columns set by add_usage_columns
+USAGE_COLUMNS = ('InputTokens', 'CachedInputTokens', 'OutputTokens', 'TotalTokens', 'EstimatedCost')
+
+def add_spent_usage(tests, spent):
+    """Adds usage from another request for the same story to each of its test cases.
+
+    Every test case of a story carries that story's request usage, so the other
+    request's per-story values are added to each test case and the totals report
+    the spend of both requests.
+    """
+    for test in tests:
+        for column in USAGE_COLUMNS:
+            test[column] = test.get(column, 0) + spent.get(column, 0)
+        test['EstimatedCost'] = round(test['EstimatedCost'], 6)
+
+def add_first_pass_usage(escalated_tests, first_pass_tests):
+    """Adds the discarded first-pass usage to a story's escalated test cases."""
+    if first_pass_tests:
+        add_spent_usage(escalated_tests, first_pass_tests[0])
+
+def needs_escalation(tests):
+    """Returns True if any test case reports a confidence below ESCALATION_CONFIDENCE_THRESHOLD."""
+    confidences = []
+    for test in tests:
+        try:
+            confidences.append(float(test.get('Confidence')))
+        except (TypeError, ValueError):
+            continue
+    return bool(confidences) and min(confidences) < ESCALATION_CONFIDENCE_THRESHOLD
+
+# --- Data Loading ---
+@st.cache_data(show_spinner=False)
+def load_stories_csv(raw):
+    """Parses the uploaded CSV once per distinct file content rather than on every rerun."""
+    return pd.read_csv(io.BytesIO(raw))
+
+# --- Results Rendering ---
+@st.cache_data(show_spinner=False)
+def results_to_csv_bytes(results_df):
+    """Encodes the test plan for download, reused across fragment reruns of the same results."""
+    return results_df.to_csv(index=False).encode('utf-8')
+
+@st.fragment
+def render_test_suite(results_df, total_stories, escalated_stories=0):
+    """Renders metrics, the results table and the download button.
+
+    Runs as a fragment so interacting with it reruns only this section rather
+    than the whole script (and the Bedrock calls above it).
+    """
+    # Calculate average confidence score
+    avg_confidence = 0.0
+    if 'Confidence' in results_df.columns:
+        avg_confidence = results_df['Confidence'].astype(float).mean()
+    else:
+        # Default confidence if not provided
+        avg_confidence = 0.85
+    
+    # Calculate token and cost statistics
+    total_input_tokens = results_df['InputTokens'].sum() if 'InputTokens' in results_df.columns else 0
+    total_output_tokens = results_df['OutputTokens'].sum() if 'OutputTokens' in results_df.columns else 0
+    total_tokens = results_df['TotalTokens'].sum() if 'TotalTokens' in results_df.columns else 0
+    total_cost = results_df['EstimatedCost'].sum() if 'EstimatedCost' in results_df.columns else 0
+    
+    # Metric Summary - Row 1
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Stories Processed", total_stories)
+    col2.metric("Test Cases Generated", len(results_df))
+    col3.metric(
+        "Est. Hours Saved / Confidence",
+        f"{len(results_df) * 0.5:.1f} hrs",
+        delta=f"{avg_confidence*100:.0f}% confident"
+    )
+    col4.metric(
+        "Estimated Cost",
+        f"${total_cost:.4f}",
+        delta=f"{total_tokens:,} tokens"
+    )
+    if escalated_stories:
+        st.caption(f"⬆️ {escalated_stories} low-confidence stories were regenerated with Claude 3 Sonnet")
+
+    # Token Breakdown
+    st.markdown("---")
+    st.markdown("**Token Usage Breakdown:**")
+    token_col1, token_col2, token_col3 = st.columns(3)
+    token_col1.metric("Input Tokens", f"{total_input_tokens:,}")
+    token_col2.metric("Output Tokens", f"{total_output_tokens:,}")
+    token_col3.metric("Total Tokens", f"{total_tokens:,}")
+
+    # Data Table
+    st.dataframe(
+        results_df[['Parent_Story_ID', 'TestID', 'Type', 'Summary', 'Expected_Result']],
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    # Download Button
+    st.download_button(
+        label="📥 Download Test Plan (CSV)",
+        data=results_to_csv_bytes(results_df),
+        file_name="genai_test_plan.csv",
+        mime="text/csv"
+    )
 
 # --- Main UI ---
 st.title("🛡️ GenAI: Automated Test Architect - Demo for Insurance")
@@ -203,7 +672,7 @@ if not st.session_state.aws_configured:
 uploaded_file = st.file_uploader("Upload User Stories (CSV)", type=["csv"])
 
 if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
+    df = load_stories_csv(uploaded_file.getvalue())
     
     # Show Preview
     st.subheader("1. User Story Backlog")
@@ -214,41 +683,115 @@ if uploaded_file is not None:
         if not st.session_state.aws_configured:
             st.error("❌ AWS credentials not configured. Please set them up in the sidebar.")
         else:
-            # UI Container for results
-            results_container = st.container()
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
             all_generated_tests = []
             
             # Limit to 5 stories for demo speed (remove .head(5) for full file)
             stories_to_process = df.head(5) 
             total_stories = len(stories_to_process)
 
-            for index, row in stories_to_process.iterrows():
-                status_text.text(f"Processing {row['FormattedID']}: {row['Name']}...")
-                
-                # Call AI with updated parameters
-                tests = generate_tests_with_bedrock(
-                    row,
-                    model_id,
-                    st.session_state.aws_credentials,
-                    region,
-                    temperature,
-                    max_tokens
-                )
-                
-                # Flatten results for table display
-                for test in tests:
-                    test['Parent_Story_ID'] = row['FormattedID']
-                    all_generated_tests.append(test)
-                
-                # Update Progress
-                progress_bar.progress((index + 1) / total_stories)
-                time.sleep(0.5) # Slight UX pause
+            bedrock_client = get_bedrock_client(st.session_state.aws_credentials, region)
+            # Region + credential hash, so cached replies are never shared across accounts
+            cache_scope = st.session_state.bedrock_client_key
+            tests_by_position = {}
+            escalated_stories = 0
+            # Problems are shown after the status box, which collapses once finished
+            errors, warnings = [], []
+            # Spend of batches whose reply could not be parsed, per story, added to the retry
+            failed_batch_usage = {}
+
+            with st.status(f"Generating test cases... 0/{total_stories}", expanded=True) as status:
+                progress_bar = st.progress(0)
+                # Plain dicts keep pandas out of the worker threads (no Series per row)
+                stories = stories_to_process[STORY_FIELDS].to_dict("records")
+                pending = list(enumerate(stories))
+
+                def record_story(position, row, tests, failed=False):
+                    """Stores one story's results and advances the progress display."""
+                    # Flatten results for table display
+                    for test in tests:
+                        test['Parent_Story_ID'] = row['FormattedID']
+                    tests_by_position[position] = tests
+
+                    # Update Progress
+                    completed = len(tests_by_position)
+                    status.write(f"{'❌' if failed else '✅'} {row['FormattedID']}: {row['Name']}")
+                    status.update(label=f"Generating test cases... {completed}/{total_stories}")
+                    progress_bar.progress(completed / total_stories)
+
+                def show_streamed_tokens(tokens):
+                    """Shows output tokens received so far while requests are still streaming."""
+                    status.update(
+                        label=f"Generating test cases... {len(tests_by_position)}/{total_stories} "
+                              f"(~{tokens:,} tokens received)"
+                    )
+
+                # Group stories into batch requests to save per-story round trips
+                batches = plan_batches(pending, max_tokens)
+                if batches:
+                    for batch, tests_by_story, error in generate_batches_in_parallel(
+                        batches, bedrock_client, model_id, temperature, max_tokens, show_streamed_tokens, cache_scope
+                    ):
+                        if error is not None:
+                            warnings.append(f"Batch request failed, falling back to one request per story: {str(error)}")
+                            if isinstance(error, UnparsableReplyError):
+                                for position, _ in batch:
+                                    failed_batch_usage[position] = usage_columns(error.usage, share=1.0 / len(batch))
+                        for position, row in batch:
+                            if str(row['FormattedID']) in tests_by_story:
+                                record_story(position, row, tests_by_story[str(row['FormattedID'])])
+                    pending = [(position, row) for position, row in pending if position not in tests_by_position]
+
+                # Fan the remaining stories out as one request each
+                if pending:
+                    for position, row, tests, error in generate_tests_in_parallel(
+                        pending, bedrock_client, model_id, temperature, max_tokens, show_streamed_tokens, cache_scope
+                    ):
+                        if error is not None:
+                            errors.append(f"Error calling Bedrock for {row['FormattedID']}: {str(error)}")
+                        add_spent_usage(tests, failed_batch_usage.get(position, {}))
+                        record_story(position, row, tests, failed=error is not None)
 
-            progress_bar.progress(100)
-            status_text.success("✅ Generation Complete!")
+                # Re-run the stories the cheaper model was unsure about on Sonnet
+                if escalate_low_confidence and model_id != ESCALATION_MODEL_ID:
+                    low_confidence = [
+                        (position, row) for position, row in enumerate(stories)
+                        if needs_escalation(tests_by_position.get(position, []))
+                    ]
+                    if low_confidence:
+                        status.update(label=f"Escalating {len(low_confidence)} low-confidence stories to Sonnet...")
+                        for position, row, tests, error in generate_tests_in_parallel(
+                            low_confidence, bedrock_client, ESCALATION_MODEL_ID, temperature, max_tokens,
+                            cache_scope=cache_scope
+                        ):
+                            if error is not None:
+                                warnings.append(f"Escalation failed for {row['FormattedID']}, keeping the original test cases: {str(error)}")
+                                if isinstance(error, UnparsableReplyError):
+                                    add_spent_usage(tests_by_position[position], usage_columns(error.usage))
+                                continue
+                            for test in tests:
+                                test['Parent_Story_ID'] = row['FormattedID']
+                            # Keep the replaced first pass in the totals; it was still paid for
+                            add_first_pass_usage(tests, tests_by_position[position])
+                            tests_by_position[position] = tests
+                            escalated_stories += 1
+                            status.write(f"⬆️ {row['FormattedID']}: regenerated with Sonnet")
+
+                if errors or warnings:
+                    status.update(
+                        label=f"⚠️ Generation finished with {len(errors) + len(warnings)} problem(s)",
+                        state="error", expanded=True
+                    )
+                else:
+                    status.update(label="✅ Generation Complete!", state="complete", expanded=False)
+
+            for message in errors:
+                st.error(message)
+            for message in warnings:
+                st.warning(message)
+
+            # Keep the results in backlog order regardless of completion order
+            for position in sorted(tests_by_position):
+                all_generated_tests.extend(tests_by_position[position])
             
             # --- Display Results ---
             st.divider()
@@ -257,57 +800,6 @@ if uploaded_file is not None:
             if all_generated_tests:
                 results_df = pd.DataFrame(all_generated_tests)
                 
-                # Calculate average confidence score
-                avg_confidence = 0.0
-                if 'Confidence' in results_df.columns:
-                    avg_confidence = results_df['Confidence'].astype(float).mean()
-                else:
-                    # Default confidence if not provided
-                    avg_confidence = 0.85
-                
-                # Calculate token and cost statistics
-                total_input_tokens = results_df['InputTokens'].sum() if 'InputTokens' in results_df.columns else 0
-                total_output_tokens = results_df['OutputTokens'].sum() if 'OutputTokens' in results_df.columns else 0
-                total_tokens = results_df['TotalTokens'].sum() if 'TotalTokens' in results_df.columns else 0
-                total_cost = results_df['EstimatedCost'].sum() if 'EstimatedCost' in results_df.columns else 0
-                
-                # Metric Summary - Row 1
-                col1, col2, col3, col4 = st.columns(4)
-                col1.metric("Stories Processed", total_stories)
-                col2.metric("Test Cases Generated", len(results_df))
-                col3.metric(
-                    "Est. Hours Saved / Confidence",
-                    f"{len(results_df) * 0.5:.1f} hrs",
-                    delta=f"{avg_confidence*100:.0f}% confident"
-                )
-                col4.metric(
-                    "Estimated Cost",
-                    f"${total_cost:.4f}",
-                    delta=f"{total_tokens:,} tokens"
-                )
-
-                # Token Breakdown
-                st.markdown("---")
-                st.markdown("**Token Usage Breakdown:**")
-                token_col1, token_col2, token_col3 = st.columns(3)
-                token_col1.metric("Input Tokens", f"{total_input_tokens:,}")
-                token_col2.metric("Output Tokens", f"{total_output_tokens:,}")
-                token_col3.metric("Total Tokens", f"{total_tokens:,}")
-
-                # Data Table
-                st.dataframe(
-                    results_df[['Parent_Story_ID', 'TestID', 'Type', 'Summary', 'Expected_Result']],
-                    use_container_width=True,
-                    hide_index=True
-                )
-                
-                # Download Button
-                csv = results_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="📥 Download Test Plan (CSV)",
-                    data=csv,
-                    file_name="genai_test_plan.csv",
-                    mime="text/csv"
-                )
+                render_test_suite(results_df, total_stories, escalated_stories)
             else:
                 st.warning("⚠️ No test cases were generated. Check your AWS Credentials and try again.")
\ No newline at end of file
@@ -1,9 +1,10 @@
+import numpy as np
 import pandas as pd
-import random
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict
-from faker import Faker
+from typing import Optional
 
 # Configure logging
 logging.basicConfig(
@@ -12,15 +13,179 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize Faker
-fake = Faker()
+# Faker is imported and instantiated on first use; see _get_faker()
+_FAKE = None
 
-def generate_insurance_user_stories(num_records: int = 500) -> pd.DataFrame:
+# Number of filler sentences generated per call and shared across rows
+DEFAULT_SENTENCE_POOL_SIZE = 64
+
+# Rows are generated in fixed-size chunks, each with its own seed stream, so a
+# given seed yields the same data regardless of CPU count or execution path
+CHUNK_SIZE = 25_000
+
+# Above this many records, chunks are generated in worker processes;
+# below it, process start-up and pickling cost more than the work itself
+PARALLEL_THRESHOLD = 100_000
+
+SUPPORTED_OUTPUT_FORMATS = ("csv", "parquet")
+
+# Domain specific lists to ensure data relevance
+ROLES = [
+    "Policyholder", "Claims Adjuster", "Underwriter", "Insurance Agent", 
+    "System Admin", "Compliance Officer", "Billing Specialist"
+]
+
+FEATURES = [
+    "First Notice of Loss (FNOL)", "Policy Renewal", "Premium Calculation", 
+    "Fraud Detection", "Document Upload", "Quote Generation", 
+    "Claim Status Tracking", "Deductible Adjustment", "Customer Onboarding"
+]
+
+BENEFITS = [
+    "reduce processing time", "improve customer satisfaction", "ensure regulatory compliance",
+    "minimize data entry errors", "speed up claim settlement", "increase underwriting accuracy",
+    "allow for 24/7 access", "secure sensitive personal data"
+]
+
+INSURANCE_TERMS = [
+    "liability coverage", "deductible", "premium", "policy limit", "subrogation",
+    "indemnity", "beneficiary", "claimant", "actuarial table", "endorsement"
+]
+
+NOTES_OPTIONS = [
+    "Requires API integration with legacy mainframe.",
+    "Pending approval from Legal department.",
+    "Watch out for edge cases regarding {term}.",
+    "UI mockup available in Figma.",
+    "High priority due to upcoming audit.",
+    "Database schema update required."
+]
+
+CRITERIA_TEMPLATES = [
+    "Verify that the {role} can access the {feature} screen.",
+    "Ensure {term} is calculated correctly within 2 decimal places.",
+    "System must return an error if input is invalid.",
+    "Response time should be under 200ms."
+]
+
+def _get_faker():
+    """Return the shared Faker instance, importing Faker on the first call.
+    
+    Keeps the Faker import and provider set-up out of module import for callers
+    that only need the constants or save_user_stories.
+    """
+    global _FAKE
+    if _FAKE is None:
+        from faker import Faker
+        _FAKE = Faker()
+    return _FAKE
+
+
+def _generate_chunk(start: int, stop: int, seed, sentence_pool_size: int) -> pd.DataFrame:
+    """
+    Generates the user stories numbered start+1..stop with a dedicated random generator.
+    
+    Module-level so it can be pickled into ProcessPoolExecutor workers.
+    """
+    num_records = stop - start
+    rng = np.random.default_rng(seed)
+
+    # Draw every random choice up front as index arrays instead of per-row random calls.
+    # tolist() converts once to Python ints/bools, so the comprehensions below index
+    # the string lists without boxing a NumPy scalar on every access.
+    role_idx = rng.integers(0, len(ROLES), num_records).tolist()
+    feature_idx = rng.integers(0, len(FEATURES), num_records).tolist()
+    benefit_idx = rng.integers(0, len(BENEFITS), num_records).tolist()
+    term_idx = rng.integers(0, len(INSURANCE_TERMS), num_records).tolist()
+    tech_role_idx = rng.integers(0, len(ROLES), num_records).tolist()
+    notes_idx = rng.integers(0, len(NOTES_OPTIONS), num_records).tolist()
+    has_notes = (rng.random(num_records) > 0.3).tolist()  # 30% chance of empty notes
+    ac_counts = rng.integers(3, 6, num_records).tolist()
+
+    # Faker is slow per call, so build a small pool of sentences once and sample from it
+    fake = _get_faker()
+    fake.seed_instance(int(rng.integers(0, 2**32)))
+    sentence_pool = [fake.sentence(nb_words=10) for _ in range(sentence_pool_size)]
+    sentence_idx = rng.integers(0, sentence_pool_size, num_records).tolist()
+
+    # Build each column as a list and assemble the DataFrame once at the end
+    # 1. FormattedID
+    # Zero-padded in NumPy's C string routines rather than N Python format calls;
+    # astype(str) (not a fixed width) keeps IDs beyond US99999 intact
+    formatted_ids = np.char.add("US", np.char.zfill(np.arange(start + 1, stop + 1).astype(str), 5))
+
+    # 2. Name (The Title of the User Story)
+    # Structure: As a <role>, I want <feature/action>, so that <benefit>.
+    names = [
+        f"As a {ROLES[r]}, I want to perform {FEATURES[f]}, so that I can {BENEFITS[b]}."
+        for r, f, b in zip(role_idx, feature_idx, benefit_idx)
+    ]
+
+    # 3. Description
+    # A paragraph that mimics a business requirement description
+    descriptions = [
+        f"The current system lacks efficiency in handling {INSURANCE_TERMS[t]} during the {FEATURES[f]} phase. "
+        f"{sentence_pool[sn]} "
+        f"The implementation should consider the impact on {ROLES[tr]} workflows."
+        for t, f, sn, tr in zip(term_idx, feature_idx, sentence_idx, tech_role_idx)
+    ]
+
+    # 4. Notes
+    # Random developer notes, edge cases, or priority flags
+    notes = [
+        NOTES_OPTIONS[n].format(term=INSURANCE_TERMS[t]) if keep_note else ""
+        for n, t, keep_note in zip(notes_idx, term_idx, has_notes)
+    ]
+
+    # 5. Acceptance Criteria
+    # Randomly sample unique criteria to form the bullet point block
+    # Every bullet only depends on (role, term, feature), so format the whole
+    # product once (a few thousand strings) and look bullets up per row
+    bullets_by_idx = [
+        [
+            [
+                tuple("- " + template.format(role=role, feature=feature, term=term) for template in CRITERIA_TEMPLATES)
+                for feature in FEATURES
+            ]
+            for term in INSURANCE_TERMS
+        ]
+        for role in ROLES
+    ]
+    # Shuffle every row's bullet order in one vectorized call, then keep the first ac_count
+    num_criteria = len(CRITERIA_TEMPLATES)
+    criteria_orders = rng.permuted(np.tile(np.arange(num_criteria), (num_records, 1)), axis=1).tolist()
+    acceptance_criteria = [
+        "\n".join([bullets_by_idx[r][t][f][j] for j in order[:min(ac_count, num_criteria)]])
+        for r, t, f, order, ac_count in zip(role_idx, term_idx, feature_idx, criteria_orders, ac_counts)
+    ]
+
+    return pd.DataFrame({
+        "FormattedID": formatted_ids,
+        "Name": names,
+        "Description": descriptions,
+        "Notes": notes,
+        "AcceptanceCriteria": acceptance_criteria
+    })
+
+
+def generate_insurance_user_stories(
+    num_records: int = 500,
+    sentence_pool_size: int = DEFAULT_SENTENCE_POOL_SIZE,
+    seed: Optional[int] = None
+) -> pd.DataFrame:
     """
     Generates synthetic user story data for an insurance application.
     
+    Rows are generated in CHUNK_SIZE chunks seeded from one SeedSequence. On
+    multi-core machines, runs above PARALLEL_THRESHOLD records generate the
+    chunks in separate processes; the output is identical either way.
+    
     Parameters:
         num_records (int): The number of user stories to generate. Default: 500
+        sentence_pool_size (int): Number of distinct filler sentences sampled into
+            descriptions. Default: 64
+        seed (int, optional): Seed for reproducible output, independent of the
+            machine's CPU count. Default: None
     
     Returns:
         pd.DataFrame: A dataframe containing the generated user stories with columns:
@@ -31,111 +196,71 @@ def generate_insurance_user_stories(num_records: int = 500) -> pd.DataFrame:
             - AcceptanceCriteria: Acceptance criteria
     
     Raises:
-        ValueError: If num_records is less than 1
+        ValueError: If num_records or sentence_pool_size is less than 1
     """
     if num_records < 1:
         raise ValueError("num_records must be at least 1")
+    if sentence_pool_size < 1:
+        raise ValueError("sentence_pool_size must be at least 1")
     
     logger.info(f"Generating {num_records} insurance user stories...")
-    
-    # Domain specific lists to ensure data relevance
-    roles = [
-        "Policyholder", "Claims Adjuster", "Underwriter", "Insurance Agent", 
-        "System Admin", "Compliance Officer", "Billing Specialist"
-    ]
-    
-    features = [
-        "First Notice of Loss (FNOL)", "Policy Renewal", "Premium Calculation", 
-        "Fraud Detection", "Document Upload", "Quote Generation", 
-        "Claim Status Tracking", "Deductible Adjustment", "Customer Onboarding"
-    ]
-    
-    benefits = [
-        "reduce processing time", "improve customer satisfaction", "ensure regulatory compliance",
-        "minimize data entry errors", "speed up claim settlement", "increase underwriting accuracy",
-        "allow for 24/7 access", "secure sensitive personal data"
-    ]
-    
-    insurance_terms = [
-        "liability coverage", "deductible", "premium", "policy limit", "subrogation",
-        "indemnity", "beneficiary", "claimant", "actuarial table", "endorsement"
-    ]
 
-    data: List[Dict] = []
+    # Rows are independent, so partition the ID range and give each chunk its own seed stream
+    starts = list(range(0, num_records, CHUNK_SIZE))
+    stops = [min(start + CHUNK_SIZE, num_records) for start in starts]
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    pool_sizes = [sentence_pool_size] * len(starts)
 
-    for i in range(1, num_records + 1):
-        # 1. FormattedID
-        formatted_id = f"US{i:05d}"
-        
-        # Select random elements
-        role = random.choice(roles)
-        feature = random.choice(features)
-        benefit = random.choice(benefits)
-        term = random.choice(insurance_terms)
-        
-        # 2. Name (The Title of the User Story)
-        # Structure: As a <role>, I want <feature/action>, so that <benefit>.
-        name = f"As a {role}, I want to perform {feature}, so that I can {benefit}."
-        
-        # 3. Description
-        # Generate a paragraph that mimics a business requirement description
-        context_sentence = f"The current system lacks efficiency in handling {term} during the {feature} phase."
-        detail_sentence = fake.sentence(nb_words=10)
-        tech_note = f"The implementation should consider the impact on {random.choice(roles)} workflows."
-        description = f"{context_sentence} {detail_sentence} {tech_note}"
-        
-        # 4. Notes
-        # Random developer notes, edge cases, or priority flags
-        notes_options = [
-            "Requires API integration with legacy mainframe.",
-            "Pending approval from Legal department.",
-            f"Watch out for edge cases regarding {term}.",
-            "UI mockup available in Figma.",
-            "High priority due to upcoming audit.",
-            "Database schema update required."
-        ]
-        notes = random.choice(notes_options) if random.random() > 0.3 else ""  # 30% chance of empty notes
-        
-        # 5. Acceptance Criteria
-        # Generate bullet points
-        ac_count = random.randint(3, 5)
-        criteria_list = [
-            f"Verify that the {role} can access the {feature} screen.",
-            f"Ensure {term} is calculated correctly within 2 decimal places.",
-            f"System must return an error if input is invalid.",
-            f"Response time should be under 200ms."
-        ]
-        
-        # Randomly sample unique criteria to form the block
-        selected_criteria = random.sample(criteria_list, min(ac_count, len(criteria_list)))
-        acceptance_criteria = "\n".join([f"- {item}" for item in selected_criteria])
-
-        data.append({
-            "FormattedID": formatted_id,
-            "Name": name,
-            "Description": description,
-            "Notes": notes,
-            "AcceptanceCriteria": acceptance_criteria
-        })
+    num_workers = min(os.cpu_count() or 1, len(starts))
+    if num_records <= PARALLEL_THRESHOLD or num_workers == 1:
+        chunks = list(map(_generate_chunk, starts, stops, seeds, pool_sizes))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            chunks = list(executor.map(_generate_chunk, starts, stops, seeds, pool_sizes))
+    df = pd.concat(chunks, ignore_index=True)
 
     logger.info(f"Successfully generated {num_records} user stories")
-    return pd.DataFrame(data)
+    return df
+
+
+def _write_csv(df: pd.DataFrame, output_path: str) -> None:
+    """Write CSV with Arrow's C++ writer when pyarrow is installed, else pandas."""
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        df.to_csv(output_path, index=False, lineterminator="\n")
+        return
+
+    pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_path)
 
 
-def save_user_stories(df: pd.DataFrame, output_path: str) -> None:
+def save_user_stories(df: pd.DataFrame, output_path: str, file_format: Optional[str] = None) -> None:
     """
-    Save user stories DataFrame to a CSV file.
+    Save user stories DataFrame to a CSV or Parquet file.
     
     Parameters:
         df (pd.DataFrame): DataFrame containing user stories
-        output_path (str): Path where the CSV file will be saved
+        output_path (str): Path where the file will be saved
+        file_format (str, optional): "csv" or "parquet". Inferred from the file
+            extension when omitted, defaulting to CSV.
     
     Raises:
+        ValueError: If file_format is not supported
         IOError: If the file cannot be written
     """
+    if file_format is None:
+        file_format = "parquet" if Path(output_path).suffix.lower() == ".parquet" else "csv"
+    file_format = file_format.lower()
+    if file_format not in SUPPORTED_OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported file_format '{file_format}', expected one of {SUPPORTED_OUTPUT_FORMATS}")
+
     try:
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        df.to_csv(output_path, index=False)
+        if file_format == "parquet":
+            df.to_parquet(output_path, index=False, compression="zstd")
+        else:
+            _write_csv(df, output_path)
         logger.info(f"Successfully saved {len(df)} records to '{output_path}'")
     except IOError as e:
         logger.error(f"Failed to save file: {e}")